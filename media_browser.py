@@ -2,25 +2,41 @@ from dataclasses import dataclass
 from typing import Dict, List, Set, Optional, NewType
 
 import argparse
-import hashlib
+import asyncio
+import functools
+import heapq
+import io
 import json
 import logging
 import mimetypes
+import multiprocessing
 import os
+import re
 import socket
 import subprocess
 import sys
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import parsedate_to_datetime
 from fractions import Fraction
 from pathlib import Path
 
+import orjson
 import uvicorn
+import xxhash
 from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image, ImageOps
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
 # ---------------- Globals ----------------
 
 BASE_DIR: Path = Path(__file__).resolve().parent
@@ -41,6 +57,10 @@ VIDEO_EXTS: Set[str] = {
     # Flash / streaming formats
     ".swf", ".asf", ".ra", ".ram", ".rm"
 }
+MIME_BY_EXT: Dict[str, str] = {
+    ext: mimetypes.guess_type(f"x{ext}")[0] or "application/octet-stream"
+    for ext in IMAGE_EXTS | VIDEO_EXTS
+}
 THUMB_SIZE = (320, 320)
 
 SEARCH_FONT_DIRS = [
@@ -57,7 +77,9 @@ class AppState:
     hls_dir: Path
     root_dirs: List[Path]
     virtual_map: Dict[str, Path]
-    font_file: object = None
+    escaped_root_map: Dict[str, Path]   # virtual_map keyed by escape_ospath
+    font_file: object = ""
+    hw_encoder: str = ""    # hardware H.264 encoder for HLS, if any
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -100,7 +122,8 @@ def parse_args():
         cache_dir=cache_dir,
         hls_dir=hls_dir,
         root_dirs=root_dirs,
-        virtual_map={}
+        virtual_map={},
+        escaped_root_map={}
     )
 
     return args, appstate
@@ -119,51 +142,54 @@ OSPATH_PREFIX = "~~OSPATH~~"
 
 OsPath = NewType("OsPath", str)
 
+# Matches "~" and the hex digits (if valid) of an escape sequence.
+_ESC_RE = re.compile(rb"~([0-9A-Fa-f]{2})?")
+
 def encode_ospath(s: str) -> OsPath:
+    if s.isascii():
+        return OsPath(s)
+    return _encode_ospath(s)
+
+@functools.lru_cache(maxsize=65536)
+def _encode_ospath(s: str) -> OsPath:
     try:
         s.encode("utf-8")
         return OsPath(s)
     except UnicodeEncodeError:
         pass
 
+    return OsPath(OSPATH_PREFIX + escape_ospath(s))
+
+def escape_ospath(s: str) -> str:
+    """
+    Escape s as it appears after OSPATH_PREFIX in an encoded path.
+    """
     b = s.encode("utf-8", errors="surrogateescape")
-    encoded = "".join(
+    return "".join(
         "~7E" if byte == 0x7E else
         chr(byte) if byte < 0x80 else
         f"~{byte:02X}"
         for byte in b
     )
-    return OsPath(OSPATH_PREFIX + encoded)
 
 def decode_ospath(ospath: OsPath) -> str:
     s = str(ospath)
     if not s.startswith(OSPATH_PREFIX):
         return s
+    return _decode_ospath(s)
 
-    s = s[len(OSPATH_PREFIX):]
-    out = bytearray()
-    i = 0
-    length = len(s)
-
-    while i < length:
-        c = s[i]
-        if c == "~":
-            if i + 2 >= length:
-                raise ValueError(f"Incomplete escape sequence at position {i}: {s[i:]}")
-            hex_part = s[i + 1:i + 3]
-            try:
-                out.append(int(hex_part, 16))
-            except ValueError:
-                raise ValueError(f"Invalid hex in escape sequence at position {i}: {hex_part}")
-            i += 3
-        else:
-            # encode a consecutive run of non-tilde characters in one go
-            start = i
-            while i < length and s[i] != "~":
-                i += 1
-            out.extend(s[start:i].encode("utf-8", errors="surrogateescape"))
+@functools.lru_cache(maxsize=65536)
+def _decode_ospath(s: str) -> str:
+    raw = s[len(OSPATH_PREFIX):].encode("utf-8", errors="surrogateescape")
 
-    return out.decode("utf-8", errors="surrogateescape")
+    def unescape(m: re.Match) -> bytes:
+        hex_part = m.group(1)
+        if hex_part is None:
+            raise ValueError(f"Invalid escape sequence at position {m.start()}: "
+                             f"{raw[m.start():m.start() + 3]!r}")
+        return bytes.fromhex(hex_part.decode("ascii"))
+
+    return _ESC_RE.sub(unescape, raw).decode("utf-8", errors="surrogateescape")
 
 # ---------------- Virtual path mapping ----------------
 
@@ -178,17 +204,26 @@ def build_virtual_map(state: AppState):
         if key in state.virtual_map:
             sys.exit(f"Duplicate directory names not allowed: {root.name}")
         state.virtual_map[key] = root
+        state.escaped_root_map[escape_ospath(root.name)] = root
 
-def build_trees(appstate: AppState) -> List[TreeNode]:
+def build_trees(appstate: AppState,
+                visited: Optional[List[tuple[Path, int]]] = None) -> List[TreeNode]:
+    """
+    If visited is given, append the path and mtime of each directory walked.
+    """
     def walk(p: Path):
-        node = TreeNode(
+        if visited is not None:
+            visited.append((p, p.stat().st_mtime_ns))
+        with os.scandir(p) as it:
+            entries = [
+                de for de in it
+                if not de.name.startswith(".") and de.is_dir()
+            ]
+        entries.sort(key=lambda de: de.name)
+        return TreeNode(
             name=encode_ospath(p.name),
-            dirs=[]
+            dirs=[walk(Path(de.path)) for de in entries]
             )
-        for d in sorted(p.iterdir()):
-            if d.is_dir() and not d.name.startswith("."):
-                node.dirs.append(walk(d))
-        return node
 
     trees = [
         walk(path)
@@ -196,28 +231,55 @@ def build_trees(appstate: AppState) -> List[TreeNode]:
     ]
     return trees
 
+# Serialized /api/tree response, and the directories (with mtimes) that
+# were walked to build it.
+tree_cache: Optional[tuple[List[tuple[Path, int]], bytes]] = None
+
+def tree_unchanged(visited: List[tuple[Path, int]]) -> bool:
+    """
+    Check that no walked directory has changed. A directory's mtime changes
+    when subdirectories are added, removed or renamed.
+    """
+    try:
+        return all(p.stat().st_mtime_ns == mtime for p, mtime in visited)
+    except OSError:
+        return False
+
 def safe_path(appstate: AppState, virtual_path: OsPath) -> Path:
     """
     Resolve virtual path (<root>/<subdir>/...) to real filesystem path,
     with basic safety checks.
+
+    The path is normalized lexically, without resolving symlinks.
     """
     try:
-        vp = decode_ospath(virtual_path)
-
-        # First segment must be a known root
-        root, *rest = vp.split("/", 1)
-        base = appstate.virtual_map[root]
+        # First segment must be a known root. Look it up before decoding,
+        # so only the remainder needs to be decoded.
+        vp = str(virtual_path)
+        if vp.startswith(OSPATH_PREFIX):
+            root, _, rest = vp[len(OSPATH_PREFIX):].partition("/")
+            base = appstate.escaped_root_map.get(root)
+            if base is None:
+                # The client joins an unencoded root name as-is onto an
+                # encoded path, so the root may not be in escaped form.
+                root = decode_ospath(OsPath(OSPATH_PREFIX + root))
+                base = appstate.virtual_map[root]
+            rest = decode_ospath(OsPath(OSPATH_PREFIX + rest))
+        else:
+            root, _, rest = vp.partition("/")
+            base = appstate.virtual_map[root]
 
-        # Resolve the remainder (if any)
         if not rest:
-            candidate = base
-        else:
-            candidate = (base / rest[0]).resolve()
+            return base
 
-        # Ensure the resolved path stays within the root
-        candidate.relative_to(base)
+        # Ensure the remainder stays within the root. This also rejects
+        # absolute paths and (on Windows) drives, as join discards base.
+        base_str = str(base)
+        norm = os.path.normpath(os.path.join(base_str, rest))
+        if os.path.commonpath([base_str, norm]) != base_str:
+            raise ValueError(f"Path escapes root: {rest}")
 
-        return candidate
+        return Path(norm)
 
     except Exception:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -233,59 +295,56 @@ def is_video(p: Path):
 
 def hash_path(path: Path) -> str:
     # This also handles non-utf-8 paths.
-    return hashlib.sha256(bytes(path)).hexdigest()
+    # The hash is only used for cache file names, so need not be cryptographic.
+    return xxhash.xxh3_128_hexdigest(bytes(path))
 
 def thumb_path(appstate: AppState, src: Path) -> Path:
+    # Two levels of sharding keep directories small for large libraries.
     h = hash_path(src)
-    return appstate.cache_dir / f"{h[:2]}/{h[2:]}.jpg"
+    return appstate.cache_dir / f"{h[:2]}/{h[2:4]}/{h[4:]}.webp"
+
+def save_thumb(im: Image.Image, dst: Path):
+    im.convert("RGB").save(dst, "WEBP", quality=80, method=4)
 
 def find_font(font_name: str) -> Optional[Path]:
-    for base_dir in SEARCH_FONT_DIRS:
-        if not base_dir.is_dir():
-            continue
-        for path in base_dir.rglob(font_name):
-            if path.is_file():
-                return path
-    return None
+    matches = (
+        Path(dirpath) / font_name
+        for base_dir in SEARCH_FONT_DIRS
+        for dirpath, _, filenames in os.walk(base_dir)
+        if font_name in filenames
+    )
+    return next(matches, None)
 
 def gen_image_thumb(src: Path, dst: Path) -> bool:
     try:
         dst.parent.mkdir(parents=True, exist_ok=True)
         with Image.open(src) as im:
+            # Let the JPEG decoder downscale via DCT scaling (no-op for other
+            # formats), leaving some headroom for the final resize.
+            im.draft("RGB", (THUMB_SIZE[0] * 2, THUMB_SIZE[1] * 2))
             im = ImageOps.exif_transpose(im)
-            im.thumbnail(THUMB_SIZE)
-            im.convert("RGB").save(dst, "JPEG", quality=85)
+            im.thumbnail(THUMB_SIZE, Image.Resampling.BILINEAR)
+            save_thumb(im, dst)
         return True
     except Exception as e:
         logger.warning(f"Failed to generate thumbnail for {src}: {e}")
         return False
 
-def gen_video_thumb(appstate: AppState, src: Path, dst: Path) -> bool:
+def gen_video_thumb(appstate: AppState, src: Path, dst: Path,
+                    sec: Optional[float]) -> bool:
     """Generate a video thumbnail with duration overlay."""
-    # First, get the video duration
-    try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error",
-             "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1",
-             str(src)],
-            capture_output=True, text=True, check=True
-        )
-        sec = float(result.stdout.strip())
+    if sec is not None:
         h,m,s = int(sec//3600), int((sec%3600)//60), int(sec%60)
         if h > 0:
             duration = f"{h}\\:{m:02d}\\:{s:02d}"
         else:
             duration = f"{m:02d}\\:{s:02d}"
-    except Exception:
+    else:
         duration = ""
 
-    # Search for font file only once.
-    if duration and appstate.font_file is None:
-        appstate.font_file = find_font("DejaVuSans.ttf") or ""
     font_file = appstate.font_file
 
-    filters = [f"thumbnail,scale={THUMB_SIZE[0]}:-1"]
+    filters = [f"scale={THUMB_SIZE[0]}:-1"]
     if duration:
         dt = f"drawtext=text='{duration}':x=w-tw-8:y=8"
         dt += ":box=1:boxborderw=8:boxcolor=0x000000aa"
@@ -295,19 +354,34 @@ def gen_video_thumb(appstate: AppState, src: Path, dst: Path) -> bool:
         filters.append(dt)
     vf = ",".join(filters)
 
+    # Take a frame 10% in (at most 10 seconds). Seeking before -i jumps to
+    # a keyframe instead of decoding from the start.
+    seek = []
+    if sec is not None:
+        seek = ["-ss", f"{min(sec * 0.1, 10.0):.3f}"]
+
     try:
         dst.parent.mkdir(parents=True, exist_ok=True)
-        subprocess.run(
-            ["ffmpeg", "-y", "-loglevel", "error",
+        # Output PNG to a pipe and encode the WebP with Pillow, as ffmpeg is
+        # not always built with libwebp.
+        result = subprocess.run(
+            ["ffmpeg", "-loglevel", "error",
+             *seek,
              "-i", str(src),
              "-frames:v", "1",
              "-vf", vf,
-             str(dst)],
-            check=False
+             "-f", "image2pipe", "-c:v", "png", "-"],
+            capture_output=True, check=False
         )
-        return dst.exists()
-    except Exception:
-        logger.warning(f"Failed to generate thumbnail for {src}")
+        if result.returncode != 0 or not result.stdout:
+            err = result.stderr.decode(errors="replace").strip()
+            logger.warning(f"Failed to generate thumbnail for {src}: {err}")
+            return False
+        with Image.open(io.BytesIO(result.stdout)) as im:
+            save_thumb(im, dst)
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to generate thumbnail for {src}: {e}")
         return False
 
 @dataclass(frozen=True)
@@ -316,7 +390,24 @@ class ThumbResult:
     ok: bool
     src_found: bool
 
-def ensure_thumb(appstate: AppState, src: Path) -> tuple[str, Path]:
+# Thumbnails are generated in worker processes so CPU-bound work does not
+# block the server. Concurrent requests for the same thumbnail share a job.
+def new_thumb_pool() -> ProcessPoolExecutor:
+    # Workers are started lazily, when the server is already running threads,
+    # so don't use fork (the default on Linux before Python 3.14).
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+    else:
+        ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=ctx)
+
+thumb_pool = new_thumb_pool()
+thumb_jobs: dict[str, asyncio.Future] = {}
+
+def check_thumb(appstate: AppState, src: Path) -> Optional[tuple[str, Path]]:
+    """
+    Return the thumbnail status if it does not need to be (re)generated.
+    """
     dst = thumb_path(appstate, src)
 
     if not src.is_file():
@@ -332,20 +423,81 @@ def ensure_thumb(appstate: AppState, src: Path) -> tuple[str, Path]:
             else:
                 return ("error", dst)
 
+    return None
+
+def ensure_thumb(appstate: AppState, src: Path,
+                 sec: Optional[float]) -> tuple[str, Path]:
+    """
+    Generate the thumbnail if needed. sec is the video duration, if known.
+    """
+    result = check_thumb(appstate, src)
+    if result is not None:
+        return result
+
     # Generate new thumbnail.
+    dst = thumb_path(appstate, src)
     generated = False
     if is_image(src):
         generated = gen_image_thumb(src, dst)
     elif is_video(src):
-        generated = gen_video_thumb(appstate, src, dst)
+        generated = gen_video_thumb(appstate, src, dst, sec)
     if generated:
         return ("ok", dst)
 
+    write_error_thumb(dst)
+    return ("error", dst)
+
+def write_error_thumb(dst: Path):
     # Leave an empty thumbnail to indicate error.
+    dst.parent.mkdir(parents=True, exist_ok=True)
     with open(dst, "wb") as f:
         f.write(b"")
+
+async def ensure_thumb_async(appstate: AppState, src: Path) -> tuple[str, Path]:
+    result = await asyncio.to_thread(check_thumb, appstate, src)
+    if result is not None:
+        return result
+
+    key = hash_path(src)
+    fut = thumb_jobs.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(run_thumb_job(appstate, src))
+        thumb_jobs[key] = fut
+        fut.add_done_callback(lambda _: thumb_jobs.pop(key, None))
+
+    # Shield the shared job from cancellation if this client goes away.
+    return await asyncio.shield(fut)
+
+async def run_thumb_job(appstate: AppState, src: Path) -> tuple[str, Path]:
+    # Probe videos in the server process, so that the result is cached for
+    # a later start_hls.
+    sec = None
+    if is_video(src):
+        info = await get_video_info(src)
+        sec = info.duration if info else None
+
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = thumb_pool
+        try:
+            return await loop.run_in_executor(pool, ensure_thumb,
+                                              appstate, src, sec)
+        except BrokenProcessPool:
+            logger.warning(f"Thumbnail worker died while processing {src}")
+            restart_thumb_pool(pool)
+
+    # Worker died twice, probably on this file. Don't try it again.
+    dst = thumb_path(appstate, src)
+    await asyncio.to_thread(write_error_thumb, dst)
     return ("error", dst)
 
+def restart_thumb_pool(broken: ProcessPoolExecutor):
+    global thumb_pool
+    # Other jobs may have seen the same broken pool.
+    if thumb_pool is broken:
+        thumb_pool = new_thumb_pool()
+        broken.shutdown(wait=False)
+
 # ---------------- Video formats ----------------
 
 @dataclass(slots=True)
@@ -358,6 +510,7 @@ class VideoInfo:
     ext: str
     video: List[StreamInfo]
     audio: List[StreamInfo]
+    duration: Optional[float] = None
 
 @dataclass(slots=True)
 class ExtendedVideoInfo:
@@ -373,15 +526,58 @@ class ExtendedVideoInfo:
     sample_rate: int
     audio_bitrate: int
 
-def get_video_info(src: Path) -> Optional[VideoInfo]:
+# LRU cache of successful probe results, keyed by (path, mtime_ns, size) so
+# that a modified file is probed again. Only used from the event loop in the
+# server process.
+VideoInfoKey = tuple[Path, int, int]
+video_info_cache: OrderedDict[VideoInfoKey, VideoInfo] = OrderedDict()
+VIDEO_INFO_CACHE_SIZE = 4096
+
+def video_info_key(src: Path) -> Optional[VideoInfoKey]:
+    try:
+        st = src.stat()
+    except OSError:
+        return None
+    return (src, st.st_mtime_ns, st.st_size)
+
+async def get_video_info(src: Path) -> Optional[VideoInfo]:
+    """
+    Probe src with ffprobe, without blocking the event loop.
+    Failures are not cached, so they are retried on the next call.
+    """
+    key = video_info_key(src)
+    if key is None:
+        return None
+    info = video_info_cache.get(key)
+    if info is not None:
+        video_info_cache.move_to_end(key)
+        return info
+
     cmd = [
         "ffprobe", "-v", "error",
-        "-show_entries", "stream=index,codec_type,codec_name",
+        "-show_entries", "stream=index,codec_type,codec_name:format=duration",
         "-of", "json",
         str(src),
     ]
     try:
-        out = subprocess.check_output(cmd)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE
+        )
+        out, _ = await proc.communicate()
+        if proc.returncode != 0:
+            return None
+    except Exception:
+        return None
+
+    info = parse_video_info(src, out)
+    if info is not None:
+        video_info_cache[key] = info
+        if len(video_info_cache) > VIDEO_INFO_CACHE_SIZE:
+            video_info_cache.popitem(last=False)
+    return info
+
+def parse_video_info(src: Path, out: bytes) -> Optional[VideoInfo]:
+    try:
         data = json.loads(out)
     except Exception:
         return None
@@ -405,8 +601,13 @@ def get_video_info(src: Path) -> Optional[VideoInfo]:
         elif ctype == "audio":
             audio.append(StreamInfo(codec=cname, index=idx))
 
+    try:
+        duration = float(data["format"]["duration"])
+    except (KeyError, ValueError, TypeError):
+        duration = None
+
     if video or audio:
-        return VideoInfo(ext=ext, video=video, audio=audio)
+        return VideoInfo(ext=ext, video=video, audio=audio, duration=duration)
 
     return None
 
@@ -509,24 +710,99 @@ class HLSJob:
     out_dir: Path
     last_access: float
     waited: bool = False
+    hw_encoder: str = ""    # hardware encoder in use, if any
 
 hls_jobs: dict[str, HLSJob] = {}
 hls_jobs_lock = threading.Lock()
+hls_jobs_cond = threading.Condition(hls_jobs_lock)
+# Min-heap of (deadline, key) for hls_reaper. A job's entry is only
+# rescheduled when the deadline passes, so bumping needs no heap update.
+hls_deadlines: list[tuple[float, str]] = []
 HLS_IDLE_TIMEOUT = 30   # seconds
 
+# In order of preference
+HW_H264_ENCODERS = ["h264_nvenc", "h264_vaapi", "h264_qsv", "h264_videotoolbox"]
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+def hw_encoder_input_args(encoder: str) -> list[str]:
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE]
+    return []
+
+def hw_encoder_filter(encoder: str) -> str:
+    # force even dimensions
+    vf = "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    if encoder == "h264_vaapi":
+        vf += ",format=nv12,hwupload"
+    return vf
+
+def find_hw_encoder() -> str:
+    """
+    Return the first hardware H.264 encoder that ffmpeg supports and which
+    works on this machine, or "" if there is none.
+    """
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True, text=True, check=True
+        )
+    except Exception:
+        return ""
+
+    available = {
+        fields[1]
+        for line in result.stdout.splitlines()
+        if len(fields := line.split()) >= 2
+    }
+
+    for encoder in HW_H264_ENCODERS:
+        if encoder not in available:
+            continue
+        # ffmpeg may be built with encoders for hardware we do not have,
+        # so try encoding a single frame.
+        cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+        cmd += hw_encoder_input_args(encoder)
+        cmd += [
+            "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+            "-frames:v", "1",
+            "-vf", hw_encoder_filter(encoder),
+            "-c:v", encoder,
+            "-f", "null", "-",
+        ]
+        try:
+            subprocess.run(cmd, capture_output=True, check=True, timeout=10)
+            return encoder
+        except Exception:
+            pass
+
+    return ""
+
+def detect_hw_encoder(appstate: AppState):
+    # Runs in a thread, as testing encoders can take a while.
+    appstate.hw_encoder = find_hw_encoder()
+    if appstate.hw_encoder:
+        logger.info(f"Using hardware video encoder: {appstate.hw_encoder}")
+
+def hls_video_needs_reencode(info: VideoInfo) -> bool:
+    video = choose_stream(info.video, HLS_VIDEO_COPY_CODECS)
+    return video is not None and video.codec not in HLS_VIDEO_COPY_CODECS
+
 def start_hls_ffmpeg_process(src: Path,
                              outdir: Path,
-                             info: VideoInfo) -> subprocess.Popen:
+                             info: VideoInfo,
+                             hw_encoder: str) -> subprocess.Popen:
     """Start producing a HLS stream to outdir."""
     outdir.mkdir(parents=True, exist_ok=True)
 
     video = choose_stream(info.video, HLS_VIDEO_COPY_CODECS)
     audio = choose_stream(info.audio, HLS_AUDIO_COPY_CODECS)
 
-    cmd = [
-        "ffmpeg", "-loglevel", "error", "-y",
-        "-i", str(src),
-    ]
+    use_hw = bool(hw_encoder) and hls_video_needs_reencode(info)
+
+    cmd = ["ffmpeg", "-loglevel", "error", "-y"]
+    if use_hw:
+        cmd += ["-hwaccel", "auto"] + hw_encoder_input_args(hw_encoder)
+    cmd += ["-i", str(src)]
 
     if video:
         cmd += ["-map", f"0:{video.index}"]
@@ -538,6 +814,14 @@ def start_hls_ffmpeg_process(src: Path,
     if video and video.codec in HLS_VIDEO_COPY_CODECS:
         msg += f"copy video ({video.codec})"
         cmd += ["-c:v", "copy"]
+    elif video and use_hw:
+        msg += f"re-encode video ({video.codec}, {hw_encoder})"
+        cmd += [
+            "-vf", hw_encoder_filter(hw_encoder),
+            "-c:v", hw_encoder,
+            "-b:v", "4M",
+            "-g", "48",
+        ]
     elif video:
         msg += f"re-encode video ({video.codec})"
         cmd += [
@@ -571,6 +855,9 @@ def start_hls_ffmpeg_process(src: Path,
         "-f", "hls",                # HLS format
         "-hls_time", "5",           # segment duration in seconds
         "-hls_list_size", "0",      # keep all segments in playlist
+        "-hls_playlist_type", "event",  # segments are only appended
+        "-hls_flags", "temp_file+independent_segments",
+                                    # only expose complete segments
         "-hls_segment_filename", str(outdir / "seg%03d.ts"),
         str(outdir / "index.m3u8"), # playlist output
     ]
@@ -580,7 +867,8 @@ def start_hls_ffmpeg_process(src: Path,
 def start_or_reuse_hls_job(src: Path,
                            key: str,
                            out_dir: Path,
-                           info: VideoInfo) -> tuple[HLSJob, bool]:
+                           info: VideoInfo,
+                           hw_encoder: str) -> tuple[HLSJob, bool]:
     """
     Ensure an HLS job exists or is running.
     """
@@ -606,21 +894,40 @@ def start_or_reuse_hls_job(src: Path,
             # client wants to get the next segments.
             playlist_path.unlink(missing_ok=True)
         incomplete_marker.touch()
-        proc = start_hls_ffmpeg_process(src, out_dir, info)
+        proc = start_hls_ffmpeg_process(src, out_dir, info, hw_encoder)
 
         job = HLSJob(
             proc=proc,
             out_dir=out_dir,
             last_access=time.time(),
+            hw_encoder=hw_encoder if hls_video_needs_reencode(info) else "",
         )
         hls_jobs[key] = job
+        heapq.heappush(hls_deadlines, (job.last_access + HLS_IDLE_TIMEOUT, key))
+        hls_jobs_cond.notify()
 
     # on_finish runs in a thread.
     def on_finish():
-        try:
-            job.proc.wait()
-        except Exception as e:
-            logger.warning(f"Exception while waiting for ffmpeg: {e}")
+        while True:
+            try:
+                job.proc.wait()
+            except Exception as e:
+                logger.warning(f"Exception while waiting for ffmpeg: {e}")
+
+            rc = job.proc.returncode
+            if not job.hw_encoder or rc is None or rc <= 0 or rc == 255:
+                break
+
+            # Hardware encoders can reject some inputs, so retry with
+            # libx264 instead of marking the file as failed.
+            with hls_jobs_lock:
+                if hls_jobs.get(key) is not job:
+                    return  # already reaped
+                logger.info(f"Job {key} - {job.hw_encoder} failed with exit code {rc}, "
+                            "retrying with libx264")
+                job.hw_encoder = ""
+                playlist_path.unlink(missing_ok=True)
+                job.proc = start_hls_ffmpeg_process(src, out_dir, info, "")
 
         with hls_jobs_lock:
             # Just in case, don't bother to wait again if idle
@@ -655,43 +962,147 @@ def hls_reaper():
     """
     Kill ffmpeg for idle jobs and remove them from memory immediately.
     """
-    while True:
-        time.sleep(5)
-        now = time.time()
-        with hls_jobs_lock:
-            for key, job in list(hls_jobs.items()):
-                idle_time = now - job.last_access
-                # logger.info(f"Job {key} - idle time: {idle_time}")
-                if idle_time > HLS_IDLE_TIMEOUT:
-                    try:
-                        if job.waited:
-                            logger.info(f"Job {key} - idle, already waited")
-                        else:
-                            logger.info(f"Job {key} - idle, killing ffmpeg process")
-                            job.proc.kill()
-                            job.proc.wait(timeout=5)
-                            job.waited = True
-                    except Exception:
-                        pass
-
-                    logger.info(f"Job {key} - removing job")
-                    del hls_jobs[key]
+    with hls_jobs_cond:
+        while True:
+            if not hls_deadlines:
+                hls_jobs_cond.wait()
+                continue
+
+            deadline, key = hls_deadlines[0]
+            now = time.time()
+            if deadline > now:
+                hls_jobs_cond.wait(deadline - now)
+                continue
+
+            heapq.heappop(hls_deadlines)
+            job = hls_jobs.get(key)
+            if job is None:
+                continue
+
+            idle_time = now - job.last_access
+            # logger.info(f"Job {key} - idle time: {idle_time}")
+            if idle_time < HLS_IDLE_TIMEOUT:
+                # Accessed since the deadline was set.
+                heapq.heappush(hls_deadlines,
+                               (job.last_access + HLS_IDLE_TIMEOUT, key))
+                continue
+
+            try:
+                if job.waited:
+                    logger.info(f"Job {key} - idle, already waited")
+                else:
+                    logger.info(f"Job {key} - idle, killing ffmpeg process")
+                    job.proc.kill()
+                    job.proc.wait(timeout=5)
+                    job.waited = True
+            except Exception:
+                pass
+
+            logger.info(f"Job {key} - removing job")
+            del hls_jobs[key]
 
 def wait_for_file_ready(path: Path, timeout: float, interval: float) -> bool:
     """
     Wait until path exists and is non-empty.
     Returns True if ready, False on timeout.
+    Uses inotify if available, otherwise polls every interval seconds.
     """
+    if INotify is not None:
+        try:
+            return wait_for_file_ready_inotify(path, timeout)
+        except OSError as e:
+            logger.warning(f"inotify failed, polling instead: {e}")
+
     deadline = time.monotonic() + timeout
     while time.monotonic() < deadline:
-        try:
-            if path.stat().st_size > 0:
-                return True
-        except FileNotFoundError:
-            pass
+        if is_file_ready(path):
+            return True
         time.sleep(interval)
     return False
 
+def wait_for_file_ready_inotify(path: Path, timeout: float) -> bool:
+    assert INotify is not None
+    deadline = time.monotonic() + timeout
+    with INotify() as inotify:
+        mask = inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+        inotify.add_watch(path.parent, mask)
+        # Check after adding the watch so no event can be missed.
+        while not is_file_ready(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            inotify.read(timeout=int(remaining * 1000) + 1)
+    return True
+
+def is_file_ready(path: Path) -> bool:
+    try:
+        return path.stat().st_size > 0
+    except FileNotFoundError:
+        return False
+
+# ---------------- Directory listings ----------------
+
+def json_dumps(obj) -> bytes:
+    return orjson.dumps(obj)
+
+def list_dir(base: Path) -> list[dict]:
+    files = []
+    with os.scandir(base) as it:
+        for de in it:
+            if de.name.startswith("."):
+                continue
+            ext = os.path.splitext(de.name)[1].lower()
+            if ext in VIDEO_EXTS:
+                type_ = "video"
+            elif ext in IMAGE_EXTS:
+                type_ = "image"
+            else:
+                continue
+            if not de.is_file():
+                continue
+            st = de.stat()
+            files.append({
+                "name": encode_ospath(de.name),
+                "type": type_,
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+            })
+    return files
+
+# ---------------- Conditional responses ----------------
+
+def is_not_modified(request: Request, st: os.stat_result, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(st.st_mtime) <= since
+
+    return False
+
+def conditional_file_response(request: Request, path: Path,
+                              media_type: str) -> Response:
+    """
+    Return a FileResponse with ETag/Last-Modified headers, or 304 Not Modified
+    if the client already has the current version.
+    """
+    st = path.stat()
+    etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+    # URLs do not change with the file contents, so clients must revalidate.
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if is_not_modified(request, st, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+    return FileResponse(path, media_type=media_type, stat_result=st,
+                        headers=headers)
+
 # ---------------- API ----------------
 
 app = FastAPI()
@@ -703,18 +1114,25 @@ def index():
     return FileResponse(BASE_DIR / "static/media_browser.html")
 
 @app.get("/api/tree")
-def tree(request: Request) -> dict:
-    dirs = build_trees(request.app.state.appstate)
-    return {"dirs": dirs}
+def tree(request: Request) -> Response:
+    global tree_cache
+    appstate = request.app.state.appstate
+    if tree_cache is None or not tree_unchanged(tree_cache[0]):
+        visited: List[tuple[Path, int]] = []
+        dirs = build_trees(appstate, visited)
+        body = json_dumps({"dirs": dirs})
+        tree_cache = (visited, body)
+    return Response(content=tree_cache[1], media_type="application/json")
 
 @app.post("/api/list-batch")
-def list_batch(request: Request, dirs: List[dict]) -> JSONResponse:
+def list_batch(request: Request, dirs: List[dict]) -> Response:
     """
     dirs: [
         {"path": "/some/dir", "since": 1690000000.0},
         {"path": "/other/dir"}
     ]
     """
+    appstate = request.app.state.appstate
     result = {}
 
     try:
@@ -722,7 +1140,7 @@ def list_batch(request: Request, dirs: List[dict]) -> JSONResponse:
             path = entry["path"]
             client_mtime = entry.get("since")
 
-            base = safe_path(request.app.state.appstate, path)
+            base = safe_path(appstate, path)
             try:
                 dir_mtime = base.stat().st_mtime
             except FileNotFoundError:
@@ -734,34 +1152,22 @@ def list_batch(request: Request, dirs: List[dict]) -> JSONResponse:
                 result[path] = {"not_modified": True}
                 continue
 
-            # Enumerate files
-            files = []
-            for p in base.iterdir():
-                if p.name.startswith("."):
-                    continue
-                if is_image(p) or is_video(p):
-                    st = p.stat()
-                    files.append({
-                        "name": encode_ospath(p.name),
-                        "type": "video" if is_video(p) else "image",
-                        "mtime": st.st_mtime,
-                        "size": st.st_size,
-                    })
-
+            files = list_dir(base)
             result[path] = {"not_modified": False, "mtime": dir_mtime, "files": files}
 
     except Exception:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
 
-    return JSONResponse(result)
+    return Response(content=json_dumps(result), media_type="application/json")
 
 @app.get("/api/thumb")
-def thumb(request: Request, path: OsPath) -> FileResponse:
+async def thumb(request: Request, path: OsPath) -> Response:
     appstate = request.app.state.appstate
     src = safe_path(appstate, path)
-    match ensure_thumb(appstate, src):
+    match await ensure_thumb_async(appstate, src):
         case ("ok", dst):
-            return FileResponse(dst, media_type="image/jpeg")
+            return await asyncio.to_thread(conditional_file_response,
+                                           request, dst, "image/webp")
         case ("src_not_found", dst):
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
         case _: # error
@@ -769,25 +1175,24 @@ def thumb(request: Request, path: OsPath) -> FileResponse:
                                 detail="Missing thumbnail")
 
 @app.get("/api/file")
-def file(request: Request, path: OsPath) -> FileResponse:
+def file(request: Request, path: OsPath) -> Response:
     appstate = request.app.state.appstate
     src = safe_path(appstate, path)
     if src.is_file():
-        mime, _ = mimetypes.guess_type(src)
-        mime = mime or "application/octet-stream"
-        return FileResponse(src, media_type=mime)
+        mime = MIME_BY_EXT.get(src.suffix.lower(), "application/octet-stream")
+        return conditional_file_response(request, src, mime)
     else:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 @app.get("/api/start_hls")
-def start_hls(request: Request, path: OsPath) -> dict:
+async def start_hls(request: Request, path: OsPath) -> dict:
     appstate = request.app.state.appstate
     src = safe_path(appstate, path)
     if not src.is_file():
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
     # Get video/audio info
-    info = get_video_info(src)
+    info = await get_video_info(src)
     if not info:
         return {"error": "Not a video or audio file"}
 
@@ -808,7 +1213,9 @@ def start_hls(request: Request, path: OsPath) -> dict:
 
     # Start or reuse HLS job
     try:
-        job, new_job = start_or_reuse_hls_job(src, key, out_dir, info)
+        job, new_job = await asyncio.to_thread(
+            start_or_reuse_hls_job, src, key, out_dir, info, appstate.hw_encoder
+        )
         if new_job:
             logger.info(f"Job {key} - new ffmpeg process")
         else:
@@ -818,7 +1225,9 @@ def start_hls(request: Request, path: OsPath) -> dict:
         return {"error": "Error starting HLS job"}
 
     # Wait a short time for the playlist to appear
-    ready = wait_for_file_ready(playlist_path, timeout=10, interval=0.2)
+    ready = await asyncio.to_thread(
+        wait_for_file_ready, playlist_path, timeout=10, interval=0.2
+    )
     if not ready:
         return {"error": "Transcode failed or timed out"}
 
@@ -887,6 +1296,12 @@ def local_hostname() -> str:
 def main():
     args, appstate = parse_args()
 
+    # Search for font file once, rather than on the first video thumbnail.
+    appstate.font_file = find_font("DejaVuSans.ttf") or ""
+
+    # Until this finishes, HLS re-encodes use libx264.
+    threading.Thread(target=detect_hw_encoder, args=(appstate,), daemon=True).start()
+
     build_virtual_map(appstate)
 
     (bind, port) = (args.bind, args.port)
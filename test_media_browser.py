@@ -0,0 +1,94 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+import media_browser as mb
+
+def make_appstate(tmp_path: Path, *roots: str) -> mb.AppState:
+    root_dirs = []
+    for name in roots:
+        d = tmp_path / name
+        d.mkdir()
+        root_dirs.append(d)
+    appstate = mb.AppState(
+        cache_dir=tmp_path / "cache",
+        hls_dir=tmp_path / "cache" / "hls",
+        root_dirs=root_dirs,
+        virtual_map={},
+        escaped_root_map={}
+    )
+    mb.build_virtual_map(appstate)
+    return appstate
+
+def test_safe_path_mixed_encoding(tmp_path):
+    # A UTF-8 root joined with a non-UTF-8 child, as the client does.
+    appstate = make_appstate(tmp_path, "Fotos_ü")
+    child = os.fsdecode(b"bad\xff")
+    vp = mb.OsPath(mb.OSPATH_PREFIX + "Fotos_ü/" + mb.escape_ospath(child))
+    assert mb.safe_path(appstate, vp) == tmp_path / "Fotos_ü" / child
+
+def test_safe_path_escaped_root(tmp_path):
+    appstate = make_appstate(tmp_path, "a~b")
+    vp = mb.OsPath(mb.OSPATH_PREFIX + "a~7Eb/x~C3~BC")
+    assert mb.safe_path(appstate, vp) == tmp_path / "a~b" / "xü"
+
+def test_safe_path_plain(tmp_path):
+    appstate = make_appstate(tmp_path, "root")
+    assert mb.safe_path(appstate, mb.OsPath("root")) == tmp_path / "root"
+    assert mb.safe_path(appstate, mb.OsPath("root/a/b.jpg")) == tmp_path / "root/a/b.jpg"
+
+@pytest.mark.parametrize("vp", [
+    "root/../x", "root/a/../../x", "root//etc", "root//etc/passwd", "other/x",
+])
+def test_safe_path_rejects(tmp_path, vp):
+    appstate = make_appstate(tmp_path, "root")
+    with pytest.raises(HTTPException):
+        mb.safe_path(appstate, mb.OsPath(vp))
+
+@pytest.mark.skipif(sys.platform != "win32", reason="Windows paths")
+@pytest.mark.parametrize("vp", [
+    "root/..\\..\\secret", "root/C:/Windows/win.ini", "root/D:/x",
+    "root/\\\\server\\share\\x",
+])
+def test_safe_path_rejects_windows(tmp_path, vp):
+    appstate = make_appstate(tmp_path, "root")
+    with pytest.raises(HTTPException):
+        mb.safe_path(appstate, mb.OsPath(vp))
+
+def test_tree_sees_deep_changes(tmp_path):
+    from fastapi.testclient import TestClient
+
+    appstate = make_appstate(tmp_path, "lib")
+    (tmp_path / "lib/sub/deep").mkdir(parents=True)
+    mb.app.state.appstate = appstate
+    client = TestClient(mb.app)
+
+    before = client.get("/api/tree").json()
+    (tmp_path / "lib/sub/deep/newdir").mkdir()
+    after = client.get("/api/tree").json()
+
+    deep = after["dirs"][0]["dirs"][0]["dirs"][0]
+    assert before != after
+    assert [d["name"] for d in deep["dirs"]] == ["newdir"]
+
+def test_list_batch_sees_modified_file(tmp_path):
+    from fastapi.testclient import TestClient
+
+    appstate = make_appstate(tmp_path, "lib")
+    img = tmp_path / "lib/a.jpg"
+    img.write_bytes(b"x" * 10)
+    mb.app.state.appstate = appstate
+    client = TestClient(mb.app)
+
+    def listed_size():
+        result = client.post("/api/list-batch", json=[{"path": "lib"}]).json()
+        return result["lib"]["files"][0]["size"]
+
+    assert listed_size() == 10
+    # Appending does not change the directory mtime.
+    with open(img, "ab") as f:
+        f.write(b"x" * 5)
+    assert listed_size() == 15